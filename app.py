@@ -1,5 +1,11 @@
 import os
-from flask import Flask, request, redirect, url_for, session, send_from_directory, flash
+import bisect
+import heapq
+import hmac
+import math
+import threading
+import time
+from flask import Flask, request, redirect, url_for, session, send_from_directory, flash, abort, jsonify
 from flask import render_template_string
 from flask_socketio import SocketIO, join_room, emit, disconnect
 
@@ -8,6 +14,14 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('CHAT_SECRET', 'dev-secret-key')
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(__file__), 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024  # 20 MB per upload
+app.config['UPLOAD_ROOM_QUOTA'] = int(os.environ.get('UPLOAD_ROOM_QUOTA', 200 * 1024 * 1024))  # bytes per room
+app.config['UPLOAD_TOTAL_QUOTA'] = int(os.environ.get('UPLOAD_TOTAL_QUOTA', 2 * 1024 * 1024 * 1024))  # bytes across all rooms
+app.config['UPLOAD_RETENTION_SECONDS'] = int(os.environ.get('UPLOAD_RETENTION_SECONDS', 7 * 24 * 3600))  # 0 keeps files until room closes
+app.config['RECLAIM_INTERVAL_SECONDS'] = int(os.environ.get('RECLAIM_INTERVAL_SECONDS', 300))
+app.config['RECLAIM_BATCH'] = 20  # files deleted between pauses
+app.config['RECLAIM_PAUSE_SECONDS'] = 0.05
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN', '')  # admin API is disabled when unset
+app.config['MESSAGE_RATE_HALFLIFE'] = 60  # seconds; decay of the per-room message rate
 
 socketio = SocketIO(app, cors_allowed_origins="*")
 
@@ -18,11 +32,39 @@ socketio = SocketIO(app, cors_allowed_origins="*")
 #     locked: bool,
 #     banned: set[str],
 #     muted: set[str],
-#     participants: { sid: { username: str, is_owner: bool } }
+#     participants: { sid: { username: str, is_owner: bool } },
+#     created: float,
+#     last_activity: float,
+#     msg_count: int,
+#     msg_weight: float   # log of forward-decayed message count, see _room_activity
 #   }
 # }
 ROOMS: dict[str, dict] = {}
 
+# Activity-ranked room indexes, kept sorted on every join/leave/message/upload so admin
+# listings cost O(page size) instead of a scan of ROOMS: {
+#   sort_key: [ (-value, room), ... ]   # ascending, so the highest value comes first
+# }
+ROOM_INDEX: dict[str, list] = { 'participants': [], 'message_rate': [], 'last_activity': [] }
+ROOM_INDEX_ENTRIES: dict[str, dict] = {}  # room -> { sort_key: its current entry in ROOM_INDEX }
+ROOM_INDEX_LOCK = threading.Lock()
+_RATE_EPOCH = time.time()
+
+# Upload usage ledger, updated on every write/delete so quota checks never walk the disk: {
+#   total: int,
+#   rooms: {
+#     room: {
+#       bytes: int,
+#       files: { filename: { size: int, mtime: float, atime: float } }
+#     }
+#   }
+# }
+UPLOAD_USAGE: dict = { 'total': 0, 'rooms': {} }
+UPLOAD_LOCK = threading.Lock()
+RECLAIM_RUNNING = threading.Lock()
+_reclaim_rerun = False
+_reclaimer_started = False
+
 
 INDEX_HTML = """
 <!doctype html>
@@ -364,6 +406,271 @@ def _safe_room(code: str) -> str:
     return ''.join(ch for ch in (code or '').strip() if ch.isalnum() or ch in ('-', '_'))
 
 
+def _ledger_set(room: str, filename: str, size: int, mtime: float):
+    # Caller holds UPLOAD_LOCK
+    usage = UPLOAD_USAGE['rooms'].setdefault(room, { 'bytes': 0, 'files': {} })
+    prev = usage['files'].get(filename)
+    delta = size - (prev['size'] if prev else 0)
+    usage['files'][filename] = { 'size': size, 'mtime': mtime, 'atime': mtime }
+    usage['bytes'] += delta
+    UPLOAD_USAGE['total'] += delta
+
+
+def _ledger_remove(room: str, filename: str):
+    # Caller holds UPLOAD_LOCK
+    usage = UPLOAD_USAGE['rooms'].get(room)
+    if not usage or filename not in usage['files']:
+        return
+    size = usage['files'].pop(filename)['size']
+    usage['bytes'] -= size
+    UPLOAD_USAGE['total'] -= size
+    if not usage['files']:
+        UPLOAD_USAGE['rooms'].pop(room, None)
+
+
+def _seed_upload_ledger():
+    # One-time walk at startup; afterwards the ledger is maintained incrementally
+    base = app.config['UPLOAD_FOLDER']
+    if not os.path.isdir(base):
+        return
+    with UPLOAD_LOCK:
+        for room_entry in os.scandir(base):
+            if room_entry.is_dir():
+                _ledger_scan_room(room_entry.name, room_entry.path)
+
+
+def _ledger_scan_room(room: str, path: str):
+    # Caller holds UPLOAD_LOCK
+    for file_entry in os.scandir(path):
+        try:
+            if not file_entry.is_file():
+                continue
+            st = file_entry.stat()
+        except OSError:
+            # Vanished or unreadable since scandir listed it; skip it
+            continue
+        _ledger_set(room, file_entry.name, st.st_size, st.st_mtime)
+
+
+def _retire_room_uploads(room: str) -> bool:
+    # A new room reusing a code must not inherit files left by the previous room with that code.
+    # Move them to a stale directory, which _safe_room can never name, for the reclaimer to delete.
+    base = app.config['UPLOAD_FOLDER']
+    room_path = os.path.join(base, room)
+    with UPLOAD_LOCK:
+        usage = UPLOAD_USAGE['rooms'].pop(room, None)
+        if not os.path.isdir(room_path):
+            if usage:
+                UPLOAD_USAGE['total'] -= usage['bytes']
+            return True
+        stale = f'.stale-{room}-{time.time_ns()}'
+        stale_path = os.path.join(base, stale)
+        try:
+            os.rename(room_path, stale_path)
+        except OSError:
+            app.logger.exception('failed to retire uploads of %s', room)
+            if usage:
+                UPLOAD_USAGE['rooms'][room] = usage
+            return False
+        # Rebuild the entry from disk so files the ledger never saw are reclaimed too
+        if usage:
+            UPLOAD_USAGE['total'] -= usage['bytes']
+        try:
+            _ledger_scan_room(stale, stale_path)
+        except OSError:
+            app.logger.exception('failed to scan retired uploads of %s', room)
+    return True
+
+
+def _upload_size(f) -> int:
+    stream = f.stream
+    pos = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(pos)
+    return size
+
+
+def _reclaim_candidates(now: float) -> list:
+    # Returns (room, filename, mtime, orphaned) tuples: files of rooms that no longer exist,
+    # files past retention, then least recently served files while over the low-water mark.
+    retention = app.config['UPLOAD_RETENTION_SECONDS']
+    total_quota = app.config['UPLOAD_TOTAL_QUOTA']
+    doomed = []
+    live = []
+    with UPLOAD_LOCK:
+        freed = 0
+        for room, usage in UPLOAD_USAGE['rooms'].items():
+            orphaned = room not in ROOMS
+            for filename, meta in usage['files'].items():
+                if orphaned or (retention and now - meta['mtime'] > retention):
+                    doomed.append((room, filename, meta['mtime'], orphaned))
+                    freed += meta['size']
+                else:
+                    live.append((meta['atime'], meta['size'], room, filename, meta['mtime']))
+        remaining = UPLOAD_USAGE['total'] - freed
+    # LRU eviction kicks in above 90% of the global quota and drains to 80%
+    if remaining > int(total_quota * 0.9):
+        excess = remaining - int(total_quota * 0.8)
+        heapq.heapify(live)
+        while live and excess > 0:
+            _, size, room, filename, mtime = heapq.heappop(live)
+            doomed.append((room, filename, mtime, False))
+            excess -= size
+    return doomed
+
+
+def _reclaim_file(room: str, filename: str, mtime: float, orphaned: bool) -> bool:
+    room_path = os.path.join(app.config['UPLOAD_FOLDER'], room)
+    # Unlink under the lock so host() cannot retire the directory and upload_file() cannot
+    # reuse the name while the delete is in flight
+    with UPLOAD_LOCK:
+        meta = UPLOAD_USAGE['rooms'].get(room, {}).get('files', {}).get(filename)
+        # Skip files re-uploaded since the scan, and rooms re-hosted under the same code
+        if not meta or meta['mtime'] != mtime or (orphaned and room in ROOMS):
+            return False
+        try:
+            os.remove(os.path.join(room_path, filename))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # Keep the ledger entry so the file still counts toward quotas and is retried
+            app.logger.exception('failed to remove upload %s/%s', room, filename)
+            return False
+        _ledger_remove(room, filename)
+        if room not in UPLOAD_USAGE['rooms']:
+            try:
+                os.rmdir(room_path)
+            except OSError:
+                pass
+    return True
+
+
+def _reclaim_pass():
+    batch = app.config['RECLAIM_BATCH']
+    pause = app.config['RECLAIM_PAUSE_SECONDS']
+    removed = 0
+    for candidate in _reclaim_candidates(time.time()):
+        if _reclaim_file(*candidate):
+            removed += 1
+            # Throttle disk I/O so reclamation yields to live traffic
+            if removed % batch == 0:
+                socketio.sleep(pause)
+    if removed:
+        app.logger.info('reclaimed %d uploaded files', removed)
+
+
+def _reclaim_uploads():
+    # Only one pass runs at a time. A request arriving mid-pass sets the rerun flag, and the
+    # running pass rescans before exiting so rooms closed after its scan are not left behind.
+    global _reclaim_rerun
+    _reclaim_rerun = True
+    while _reclaim_rerun:
+        if not RECLAIM_RUNNING.acquire(blocking=False):
+            return
+        try:
+            while _reclaim_rerun:
+                _reclaim_rerun = False
+                _reclaim_pass()
+        finally:
+            RECLAIM_RUNNING.release()
+
+
+def _reclaimer_loop():
+    while True:
+        try:
+            _reclaim_uploads()
+        except Exception:
+            app.logger.exception('upload reclaim pass failed')
+        socketio.sleep(app.config['RECLAIM_INTERVAL_SECONDS'])
+
+
+@app.before_request
+def _ensure_reclaimer():
+    global _reclaimer_started
+    if _reclaimer_started:
+        return
+    _reclaimer_started = True
+    try:
+        _seed_upload_ledger()
+    except Exception:
+        app.logger.exception('failed to seed upload ledger')
+    socketio.start_background_task(_reclaimer_loop)
+
+
+def _rate_decay() -> float:
+    return math.log(2) / app.config['MESSAGE_RATE_HALFLIFE']
+
+
+def _log_add(a: float, b: float) -> float:
+    hi, lo = max(a, b), min(a, b)
+    if lo == -math.inf:
+        return hi
+    return hi + math.log1p(math.exp(lo - hi))
+
+
+def _index_update(room: str):
+    r = ROOMS[room]
+    values = { 'participants': len(r['participants']), 'message_rate': r['msg_weight'], 'last_activity': r['last_activity'] }
+    with ROOM_INDEX_LOCK:
+        entries = ROOM_INDEX_ENTRIES.setdefault(room, {})
+        for key, value in values.items():
+            entry = (-value, room)
+            prev = entries.get(key)
+            if prev == entry:
+                continue
+            index = ROOM_INDEX[key]
+            if prev is not None:
+                del index[bisect.bisect_left(index, prev)]
+            bisect.insort(index, entry)
+            entries[key] = entry
+
+
+def _index_remove(room: str):
+    with ROOM_INDEX_LOCK:
+        for key, entry in ROOM_INDEX_ENTRIES.pop(room, {}).items():
+            index = ROOM_INDEX[key]
+            i = bisect.bisect_left(index, entry)
+            if i < len(index) and index[i] == entry:
+                del index[i]
+
+
+def _room_activity(room: str, message: bool = False):
+    now = time.time()
+    r = ROOMS[room]
+    r['last_activity'] = now
+    if message:
+        # Forward decay: each message adds exp(decay * (t - epoch)). Every room decays by the
+        # same factor over time, so the ranking only changes when a room gets a message.
+        r['msg_count'] += 1
+        r['msg_weight'] = _log_add(r['msg_weight'], _rate_decay() * (now - _RATE_EPOCH))
+    _index_update(room)
+
+
+def _messages_per_minute(room: str, now: float) -> float:
+    decay = _rate_decay()
+    weight = ROOMS[room]['msg_weight']
+    if weight == -math.inf:
+        return 0.0
+    return 60 * decay * math.exp(weight - decay * (now - _RATE_EPOCH))
+
+
+def _close_room(room: str):
+    # Disconnect everyone and remove room; callers schedule upload reclamation
+    parts = list(ROOMS[room]['participants'].keys())
+    for sid in parts:
+        socketio.emit('kicked', {}, to=sid)
+        disconnect(sid, namespace='/')
+    ROOMS.pop(room, None)
+    _index_remove(room)
+
+
+def _admin_authorized() -> bool:
+    token = app.config['ADMIN_TOKEN']
+    supplied = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(supplied.encode(), f'Bearer {token}'.encode())
+
+
 @app.get('/')
 def index():
     return render_template_string(INDEX_HTML)
@@ -380,7 +687,13 @@ def host():
     if room in ROOMS:
         flash('Room code already exists. Choose another.')
         return redirect(url_for('index'))
-    ROOMS[room] = { 'password': password, 'owner_sid': None, 'locked': False, 'banned': set(), 'muted': set(), 'participants': {} }
+    if not _retire_room_uploads(room):
+        flash('Room code is unavailable right now. Choose another.')
+        return redirect(url_for('index'))
+    now = time.time()
+    ROOMS[room] = { 'password': password, 'owner_sid': None, 'locked': False, 'banned': set(), 'muted': set(), 'participants': {},
+                    'created': now, 'last_activity': now, 'msg_count': 0, 'msg_weight': -math.inf }
+    _index_update(room)
     session['username'] = username
     session['room'] = room
     session['is_owner'] = True
@@ -428,6 +741,9 @@ def upload_file():
     if not username or not room:
         flash('Not authorized')
         return redirect(url_for('index'))
+    if room not in ROOMS:
+        flash('No active room')
+        return redirect(url_for('index'))
     if 'file' not in request.files:
         flash('No file part')
         return redirect(url_for('chat', room=room))
@@ -436,10 +752,53 @@ def upload_file():
         flash('No selected file')
         return redirect(url_for('chat', room=room))
     room_path = os.path.join(app.config['UPLOAD_FOLDER'], room)
-    os.makedirs(room_path, exist_ok=True)
     filename = os.path.basename(f.filename)
     save_path = os.path.join(room_path, filename)
-    f.save(save_path)
+    size = _upload_size(f)
+    # Check quotas and reserve the bytes before touching the disk
+    with UPLOAD_LOCK:
+        usage = UPLOAD_USAGE['rooms'].get(room, { 'bytes': 0, 'files': {} })
+        prev = usage['files'].get(filename)
+        delta = size - (prev['size'] if prev else 0)
+        if usage['bytes'] + delta > app.config['UPLOAD_ROOM_QUOTA']:
+            flash('Room upload quota exceeded')
+            return redirect(url_for('chat', room=room))
+        if UPLOAD_USAGE['total'] + delta > app.config['UPLOAD_TOTAL_QUOTA']:
+            flash('Upload storage is full, try again later')
+            # Free space now instead of waiting for the next periodic pass
+            socketio.start_background_task(_reclaim_uploads)
+            return redirect(url_for('chat', room=room))
+        _ledger_set(room, filename, size, time.time())
+    # Write to a temporary name and swap it in, so a failed save never touches an existing file
+    tmp_name = f'.{filename}.{time.time_ns()}.part'
+    tmp_path = os.path.join(room_path, tmp_name)
+    try:
+        os.makedirs(room_path, exist_ok=True)
+        f.save(tmp_path)
+        os.replace(tmp_path, save_path)
+    except OSError:
+        app.logger.exception('failed to save upload %s/%s', room, filename)
+        with UPLOAD_LOCK:
+            _ledger_remove(room, filename)
+            if prev:
+                _ledger_set(room, filename, prev['size'], prev['mtime'])
+                UPLOAD_USAGE['rooms'][room]['files'][filename]['atime'] = prev['atime']
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Track the leftover so the reclaimer still deletes it
+                app.logger.exception('failed to remove partial upload %s/%s', room, tmp_name)
+                try:
+                    st = os.stat(tmp_path)
+                    _ledger_set(room, tmp_name, st.st_size, st.st_mtime)
+                except OSError:
+                    pass
+        flash('Upload failed')
+        return redirect(url_for('chat', room=room))
+    if room in ROOMS:
+        _room_activity(room)
     file_url = url_for('serve_file', room=room, filename=filename)
     socketio.emit('chat_message', {
         'username': username,
@@ -453,6 +812,13 @@ def upload_file():
 @app.get('/files/<room>/<path:filename>')
 def serve_file(room, filename):
     room = _safe_room(room)
+    # Files of closed rooms are pending reclamation; stop serving them
+    if room not in ROOMS:
+        abort(404)
+    with UPLOAD_LOCK:
+        meta = UPLOAD_USAGE['rooms'].get(room, {}).get('files', {}).get(filename)
+        if meta:
+            meta['atime'] = time.time()
     room_path = os.path.join(app.config['UPLOAD_FOLDER'], room)
     return send_from_directory(room_path, filename)
 
@@ -484,12 +850,9 @@ def close_room():
     if not session.get('is_owner'):
         flash('Only owner can close room')
         return redirect(url_for('chat', room=room))
-    # Disconnect everyone and remove room
-    parts = list(ROOMS[room]['participants'].keys())
-    for sid in parts:
-        socketio.emit('kicked', {}, to=sid)
-        disconnect(sid)
-    ROOMS.pop(room, None)
+    _close_room(room)
+    # Reclaim the room's uploads now rather than waiting for the next periodic pass
+    socketio.start_background_task(_reclaim_uploads)
     session.pop('room', None)
     session.pop('is_owner', None)
     flash('Room closed')
@@ -523,6 +886,72 @@ def switch_room():
     return redirect(url_for('chat', room=room))
 
 
+@app.get('/admin/api/rooms')
+def admin_list_rooms():
+    if not _admin_authorized():
+        return jsonify({ 'error': 'unauthorized' }), 401
+    sort = request.args.get('sort', 'last_activity')
+    if sort not in ROOM_INDEX:
+        return jsonify({ 'error': 'sort must be one of: ' + ', '.join(ROOM_INDEX) }), 400
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    now = time.time()
+    with ROOM_INDEX_LOCK:
+        total = len(ROOM_INDEX[sort])
+        page = [room for _, room in ROOM_INDEX[sort][offset:offset + limit]]
+    rooms = []
+    for room in page:
+        r = ROOMS.get(room)
+        if not r:
+            continue
+        rooms.append({
+            'room': room,
+            'participants': len(r['participants']),
+            'locked': bool(r['locked']),
+            'created': r['created'],
+            'last_activity': r['last_activity'],
+            'messages': r['msg_count'],
+            'messages_per_minute': round(_messages_per_minute(room, now), 3),
+            'upload_bytes': UPLOAD_USAGE['rooms'].get(room, {}).get('bytes', 0),
+        })
+    next_offset = offset + len(page) if offset + len(page) < total else None
+    return jsonify({ 'sort': sort, 'total': total, 'offset': offset, 'next_offset': next_offset, 'rooms': rooms })
+
+
+@app.post('/admin/api/rooms/close_idle')
+def admin_close_idle_rooms():
+    if not _admin_authorized():
+        return jsonify({ 'error': 'unauthorized' }), 401
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    try:
+        idle_seconds = int(data.get('idle_seconds', request.args.get('idle_seconds', 3600)))
+    except (TypeError, ValueError, OverflowError):
+        return jsonify({ 'error': 'idle_seconds must be an integer' }), 400
+    if idle_seconds < 0:
+        return jsonify({ 'error': 'idle_seconds must not be negative' }), 400
+    now = time.time()
+    cutoff = now - min(idle_seconds, int(now))
+    # Least recently active rooms sit at the tail of the index; stop at the first active one
+    idle = []
+    with ROOM_INDEX_LOCK:
+        index = ROOM_INDEX['last_activity']
+        for i in range(len(index) - 1, -1, -1):
+            neg_ts, room = index[i]
+            if -neg_ts >= cutoff:
+                break
+            idle.append(room)
+    closed = []
+    for room in idle:
+        if room in ROOMS:
+            _close_room(room)
+            closed.append(room)
+    if closed:
+        socketio.start_background_task(_reclaim_uploads)
+    return jsonify({ 'closed': closed })
+
+
 def _broadcast_participants(room: str):
     parts = ROOMS[room]['participants']
     muted = ROOMS[room]['muted']
@@ -546,6 +975,7 @@ def on_join(data):
     # Assign owner_sid if hosting and not set
     if is_owner and not ROOMS[room]['owner_sid']:
         ROOMS[room]['owner_sid'] = request.sid
+    _room_activity(room)
     emit('chat_message', { 'username': 'system', 'room': room, 'text': f'{username} joined the room.' }, room=room)
     _broadcast_participants(room)
 
@@ -565,6 +995,7 @@ def on_disconnect():
                 ROOMS[room]['owner_sid'] = sid
                 info['is_owner'] = True
                 break
+        _room_activity(room)
         emit('chat_message', { 'username': 'system', 'room': room, 'text': f'{username} left the room.' }, room=room)
         if room in ROOMS:
             _broadcast_participants(room)
@@ -581,6 +1012,7 @@ def handle_chat_message(data):
     if request.sid in ROOMS[room]['muted']:
         emit('chat_message', { 'username': 'system', 'room': room, 'text': 'You are muted by the owner.' }, to=request.sid)
         return
+    _room_activity(room, message=True)
     emit('chat_message', { 'username': username, 'room': room, 'text': text }, room=room)
 
 